@@ -5,19 +5,37 @@
 #   Packing algorithm devised by Sotiris Sanidas 2019.
 #
 
+import argparse
 import logging
+import os
 import os.path
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from timeit import default_timer as timer
 
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
+
+logger = logging.getLogger()
+
+# importing numba and loading the compiled packing function take a few hundred
+# ms, which only pays off against the k-d tree for large numbers of beams
+NUMBA_MIN_BEAMS = 20000
+
+# the packing function compiled with numba, see _get_pack_greedy
+_pack_greedy_compiled = None
 
 
 def load_data(filename):
     """
     Load the beam position data from file.
 
+    The parsed data are cached in a binary `.npy` file next to the input file,
+    which is memory-mapped on subsequent loads as long as it is up to date.
+
     Parameters
     ----------
     filename : str
@@ -25,20 +43,79 @@ def load_data(filename):
     """
 
     if not os.path.isfile(filename):
-        raise RuntimeError("Input file does not exist: {filename}")
+        raise RuntimeError("Input file does not exist: {0}".format(filename))
+
+    dtype = np.dtype([("x", float), ("y", float)])
+    cachename = "{0}.npy".format(filename)
+
+    if os.path.isfile(cachename) and os.path.getmtime(cachename) >= os.path.getmtime(
+        filename
+    ):
+        logger.info("Loading cached beam positions: {0}".format(cachename))
+
+        # ignore unreadable caches and those written with a different data type
+        try:
+            data = np.load(cachename, mmap_mode="r")
+        except (OSError, ValueError, EOFError) as e:
+            logger.warning("Could not load the cached beam positions: {0}".format(e))
+        else:
+            if data.dtype == dtype:
+                return data
+
+    data = np.loadtxt(filename, delimiter="\t", dtype=dtype)
 
-    dtype = [("x", float), ("y", float)]
-    data = np.genfromtxt(filename, delimiter="\t", dtype=dtype)
+    # write to a temporary file first, so that an interrupted run does not
+    # leave a truncated cache behind
+    tempname = "{0}.{1}.tmp".format(cachename, os.getpid())
+
+    try:
+        with open(tempname, "wb") as f:
+            np.save(f, data)
+        os.replace(tempname, cachename)
+    except OSError as e:
+        logger.warning("Could not cache the beam positions: {0}".format(e))
+
+        if os.path.isfile(tempname):
+            os.remove(tempname)
 
     return data
 
 
-def plot_beam_centres(t_data):
+def save_figure(fig, basename, publish):
     """
-    Plot an overview of the beam centres.
+    Save a figure to file.
+
+    Parameters
+    ----------
+    fig : ~matplotlib.figure.Figure
+        The figure to save.
+    basename : str
+        The output filename without extension.
+    publish : bool
+        Whether to output publication quality figures, i.e. a PDF and a
+        high-resolution PNG. Otherwise, only a low-resolution PNG is written.
+    """
+
+    if publish:
+        fig.savefig("{0}.pdf".format(basename), bbox_inches="tight")
+        fig.savefig("{0}.png".format(basename), bbox_inches="tight", dpi=200)
+    else:
+        fig.savefig("{0}.png".format(basename), bbox_inches="tight", dpi=100)
+
+    plt.close(fig)
+
+
+def plot_beam_centres(data, publish=False):
     """
+    Plot an overview of the beam centres.
 
-    data = np.copy(t_data)
+    Parameters
+    ----------
+    data : numpy rec
+        The beam positions.
+    publish : bool
+        Whether to output publication quality figures.
+    """
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -51,17 +128,20 @@ def plot_beam_centres(t_data):
 
     fig.tight_layout()
 
-    fig.savefig("beam_centres.pdf", bbox_inches="tight")
-
-    fig.savefig("beam_centres.png", bbox_inches="tight", dpi=200)
+    save_figure(fig, "beam_centres", publish)
 
 
-def plot_beam_packing(t_data):
+def plot_beam_packing(data, publish=False):
     """
     Plot the beam packing.
-    """
 
-    data = np.copy(t_data)
+    Parameters
+    ----------
+    data : numpy rec
+        The packed beams.
+    publish : bool
+        Whether to output publication quality figures.
+    """
 
     prop_cycle = plt.rcParams["axes.prop_cycle"]
     colors = prop_cycle.by_key()["color"]
@@ -97,19 +177,20 @@ def plot_beam_packing(t_data):
 
     fig.tight_layout()
 
-    fig.savefig("beam_mapping.pdf", bbox_inches="tight")
+    save_figure(fig, "beam_mapping", publish)
 
-    fig.savefig("beam_mapping.png", bbox_inches="tight", dpi=200)
 
-
-def plot_packing_metric(t_data):
+def plot_packing_metric(data, publish=False):
     """
     Visualize the packing metrics.
-    """
 
-    data = np.copy(t_data)
-
-    data = np.sort(data, order="totdist")
+    Parameters
+    ----------
+    data : numpy rec
+        The packing metrics.
+    publish : bool
+        Whether to output publication quality figures.
+    """
 
     info_str = "min: {0:.2f}".format(np.min(data["totdist"]))
     info_str += ", median: {0:.2f}".format(np.median(data["totdist"]))
@@ -128,8 +209,7 @@ def plot_packing_metric(t_data):
 
     fig.tight_layout()
 
-    fig.savefig("packing_metric.pdf", bbox_inches="tight")
-    fig.savefig("packing_metric.png", bbox_inches="tight", dpi=200)
+    save_figure(fig, "packing_metric", publish)
 
     # cummulative
     fig = plt.figure()
@@ -152,9 +232,179 @@ def plot_packing_metric(t_data):
 
     fig.tight_layout()
 
-    fig.savefig("packing_metric_cum.pdf", bbox_inches="tight")
+    save_figure(fig, "packing_metric_cum", publish)
+
+
+def _pack_tree(xs, ys, nrs, bunch, groups):
+    """
+    Greedy nearest-neighbour packing using a k-d tree.
+
+    Parameters
+    ----------
+    xs, ys : ~np.array
+        The horizontal and vertical beam coordinates, sorted in `xs`.
+    nrs : ~np.array
+        The beam numbers, used to break distance ties.
+    bunch: int
+        Number of beams to pack into a group.
+    groups : ~np.array
+        Output array that receives the group number of each beam.
+    """
 
-    fig.savefig("packing_metric_cum.png", bbox_inches="tight", dpi=200)
+    # build the tree once and track the beams that are still unassigned
+    tree = cKDTree(np.column_stack((xs, ys)))
+    alive = np.ones(len(xs), dtype=bool)
+    nalive = len(xs)
+
+    # query more neighbours than needed, as some are already assigned
+    oversample = 3
+
+    group = 0
+    seed = 0
+
+    while nalive > 0:
+        # the data are sorted in x, i.e. the seed is the first remaining beam
+        while not alive[seed]:
+            seed += 1
+
+        k = bunch * oversample
+
+        while True:
+            _, nbrs = tree.query(tree.data[seed], k=min(k, len(xs)))
+            nbrs = np.atleast_1d(nbrs)
+
+            # rank by the distances of the neighbours, squared distances can
+            # split ties that the rounded distances have
+            dist = xs[nbrs] - xs[seed]
+            dy = ys[nbrs] - ys[seed]
+            np.multiply(dist, dist, out=dist)
+            np.multiply(dy, dy, out=dy)
+            np.add(dist, dy, out=dist)
+            np.sqrt(dist, out=dist)
+            mask = alive[nbrs]
+
+            # all beams closer than the last neighbour are in the result, keep
+            # a margin as the tree computes the distances slightly differently
+            last = np.max(dist) * (1 - 1e-9)
+            if k >= len(xs) or np.sum(mask & (dist < last)) >= bunch:
+                break
+
+            k *= 2
+
+        dist = dist[mask]
+        nbrs = nbrs[mask]
+
+        # pick the closest `bunch` beams and break distance ties by beam
+        # number
+        picked = nbrs[np.lexsort((nrs[nbrs], dist))][:bunch]
+
+        groups[picked] = group
+        alive[picked] = False
+        nalive -= len(picked)
+
+        group += 1
+
+
+def _pack_greedy(xs, ys, nrs, bunch, groups):
+    """
+    Greedy nearest-neighbour packing using a brute-force search.
+
+    This is compiled with numba on first use, see `_get_pack_greedy`.
+
+    Parameters
+    ----------
+    xs, ys : ~np.array
+        The horizontal and vertical beam coordinates, sorted in `xs`.
+    nrs : ~np.array
+        The beam numbers, used to break distance ties.
+    bunch: int
+        Number of beams to pack into a group.
+    groups : ~np.array
+        Output array that receives the group number of each beam.
+    """
+
+    alive = np.ones(len(xs), dtype=np.bool_)
+    nalive = len(xs)
+
+    # the closest beams found so far and the slot of the farthest of them
+    best_d = np.empty(bunch, dtype=xs.dtype)
+    best_i = np.empty(bunch, dtype=np.int64)
+
+    group = 0
+    seed = 0
+
+    while nalive > 0:
+        # the data are sorted in x, i.e. the seed is the first remaining beam
+        while not alive[seed]:
+            seed += 1
+
+        nbest = 0
+        worst = 0
+
+        for i in range(seed, len(xs)):
+            if not alive[i]:
+                continue
+
+            dx = xs[i] - xs[seed]
+
+            # the data are sorted in x, i.e. no beam further to the right can
+            # be closer than the farthest of the closest beams, a beam at the
+            # same distance can still win the tie on its beam number
+            if nbest == bunch and np.sqrt(dx * dx) > best_d[worst]:
+                break
+
+            dy = ys[i] - ys[seed]
+            dist = np.sqrt(dx * dx + dy * dy)
+
+            if nbest < bunch:
+                best_d[nbest] = dist
+                best_i[nbest] = i
+                nbest += 1
+            elif dist < best_d[worst] or (
+                dist == best_d[worst] and nrs[i] < nrs[best_i[worst]]
+            ):
+                best_d[worst] = dist
+                best_i[worst] = i
+            else:
+                continue
+
+            # find the farthest beam, distance ties are broken by beam number
+            worst = 0
+            for j in range(1, nbest):
+                if best_d[j] > best_d[worst] or (
+                    best_d[j] == best_d[worst] and nrs[best_i[j]] > nrs[best_i[worst]]
+                ):
+                    worst = j
+
+        for j in range(nbest):
+            groups[best_i[j]] = group
+            alive[best_i[j]] = False
+
+        nalive -= nbest
+        group += 1
+
+
+def _get_pack_greedy():
+    """
+    Compile the brute-force packing with numba on first use.
+
+    Returns
+    -------
+    pack : function or None
+        The compiled packing function or `None` if numba is not available.
+    """
+
+    global _pack_greedy_compiled
+
+    if _pack_greedy_compiled is None:
+        try:
+            from numba import njit
+        except ImportError:
+            return None
+
+        _pack_greedy_compiled = njit(cache=True)(_pack_greedy)
+
+    return _pack_greedy_compiled
 
 
 def get_beam_packing(beams, nbeams=396, bunch=6):
@@ -180,99 +430,109 @@ def get_beam_packing(beams, nbeams=396, bunch=6):
         where `x` and `y` are the on-sky horizontal and vertical coordinates of beam `nr`. `group` defines the multicast
         address number, i.e. the compute node. The resulting record is sorted by `group` number in ascending order.
     """
-    logger = logging.getLogger()
-
-    # add additional fields for output
-    dtype = [("nr", int), ("x", float), ("y", float), ("group", int)]
-    data = np.zeros(len(beams), dtype=dtype)
-
-    data["nr"] = np.arange(len(data))
-    for field in beams.dtype.names:
-        data[field] = beams[field]
-
-    data = np.sort(data, order="x")
+    # sort in x, ties are broken by beam number
+    order = np.argsort(beams["x"], kind="stable")
 
     # only consider that many beams
-    if len(data) >= nbeams:
-        data = data[0:nbeams]
+    if len(order) >= nbeams:
+        order = order[0:nbeams]
         logger.info("Removed additional beams.")
 
-    dtype = [("nr", int), ("x", float), ("y", float), ("dist", float)]
-    group = 0
-
-    work = np.copy(data)
-
-    while len(work) > 0:
-        logger.debug("Length: {0}".format(len(work)))
+    # assemble the output record with additional fields in one go
+    dtype = [("nr", int), ("x", float), ("y", float), ("group", int)]
+    data = np.zeros(len(order), dtype=dtype)
 
-        dist = np.sqrt(
-            (work["x"] - work["x"][0]) ** 2 + (work["y"] - work["y"][0]) ** 2
-        )
-        tot = np.zeros(len(work), dtype=dtype)
+    data["nr"] = order
+    data["x"] = beams["x"][order]
+    data["y"] = beams["y"][order]
 
-        for field in ["nr", "x", "y"]:
-            tot[field] = work[field]
+    xs = np.ascontiguousarray(data["x"])
+    ys = np.ascontiguousarray(data["y"])
+    nrs = np.ascontiguousarray(data["nr"])
+    groups = np.zeros(len(data), dtype=int)
 
-        tot["dist"] = dist
+    pack = None
 
-        tot = np.sort(tot, order="dist")
+    if len(data) >= NUMBA_MIN_BEAMS:
+        pack = _get_pack_greedy()
 
-        # pick the closest `bunch` beams
-        picked = tot[0:bunch]
-        logger.debug("Group: {0}, beams: {1}".format(group, picked["nr"]))
+    if pack is not None:
+        pack(xs, ys, nrs, bunch, groups)
+    else:
+        _pack_tree(xs, ys, nrs, bunch, groups)
 
-        mask_work = np.isin(work["nr"], picked["nr"], invert=True)
-        mask_data = np.isin(data["nr"], picked["nr"])
-        work = work[mask_work]
-        data["group"][mask_data] = group
+    data["group"] = groups
 
-        group += 1
+    if logger.isEnabledFor(logging.DEBUG):
+        for group in np.unique(groups):
+            logger.debug("Group: %d, beams: %s", group, data["nr"][groups == group])
 
-    data = np.sort(data, order="group")
+    data.sort(order="group")
 
     return data
 
 
-def check_beam_packing(t_data):
+def check_beam_packing(data):
     """
     Evaluate the beam packing using various metrics.
     """
 
-    data = np.copy(t_data)
+    # order the beams by group, so that each group is a contiguous slice
+    order = np.argsort(data["group"], kind="stable")
+    groups = data["group"][order]
+    coords = np.column_stack((data["x"][order], data["y"][order]))
 
-    data = np.sort(data, order="group")
-
-    logger = logging.getLogger()
+    ngroups = np.max(groups) + 1
+    bounds = np.searchsorted(groups, np.arange(ngroups + 1))
 
     dtype = [("group", int), ("totdist", float)]
-    info = np.zeros(np.max(data["group"]) + 1, dtype=dtype)
+    info = np.zeros(ngroups, dtype=dtype)
+    info["group"] = np.arange(ngroups)
 
-    for group in np.unique(data["group"]):
-        indiv = data[data["group"] == group]
+    for group in range(ngroups):
+        # sum of all pairwise distances
+        totdist = np.sum(pdist(coords[bounds[group] : bounds[group + 1]]))
+        logger.debug("Group: %d, total distance: %f", group, totdist)
 
-        indiv = np.sort(indiv, order="x")
+        info["totdist"][group] = totdist
 
-        totdist = 0
+    return info
 
-        for nr in range(len(indiv) - 1):
-            dist = np.sqrt(
-                (indiv["x"][nr + 1 :] - indiv["x"][nr]) ** 2
-                + (indiv["y"][nr + 1 :] - indiv["y"][nr]) ** 2
-            )
-            value = np.sum(dist)
-            logger.debug(
-                "Group: {0}, nr: {1}, dist: {2}, val: {3}".format(
-                    group, nr, dist, value
-                )
-            )
 
-            totdist += value
-            logger.debug("Total distance: {0}".format(totdist))
+def parse_args():
+    """
+    Parse the commandline arguments.
 
-        info["group"][group] = group
-        info["totdist"][group] = totdist
+    Returns
+    -------
+    args: populated namespace
+        The commandline arguments.
+    """
 
-    return info
+    parser = argparse.ArgumentParser(
+        description="Compute the beam packing for MeerTRAP.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        dest="plot",
+        default=False,
+        help="Plot the beam positions, the packing and the packing metrics."
+    )
+
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        dest="publish",
+        default=False,
+        help="Output publication quality figures, i.e. PDFs and high-resolution PNGs."
+    )
+
+    args = parser.parse_args()
+
+    return args
 
 
 def setup_logger(level):
@@ -307,34 +567,51 @@ def setup_logger(level):
 
 
 def main():
-    logger = logging.getLogger()
+    args = parse_args()
+
     setup_logger(logging.ERROR)
 
     infile = os.path.join("input", "134.0696_90.0_beam_pos.dat")
     data = load_data(infile)
 
-    plot_beam_centres(data)
+    # the figures are only saved to file, so render them off-screen in
+    # worker processes while the computation continues
+    if args.plot:
+        plt.switch_backend("agg")
+        pool = ProcessPoolExecutor()
+    else:
+        pool = nullcontext()
+
+    with pool as executor:
+        plots = []
+
+        if args.plot:
+            plots.append(executor.submit(plot_beam_centres, data, args.publish))
 
-    start = timer()
-    packed = get_beam_packing(data)
-    end = timer()
+        start = timer()
+        packed = get_beam_packing(data)
+        end = timer()
 
-    print("Elapsed time: {0:.2f} ms".format(1000 * (end - start)))
+        print("Elapsed time: {0:.2f} ms".format(1000 * (end - start)))
 
-    for item in packed:
-        logger.info("Beam: {0}, group: {1}".format(item["nr"], item["group"]))
+        for item in packed:
+            logger.info("Beam: %d, group: %d", item["nr"], item["group"])
 
-    plot_beam_packing(packed)
+        if args.plot:
+            plots.append(executor.submit(plot_beam_packing, packed, args.publish))
 
-    start = timer()
-    metric = check_beam_packing(packed)
-    end = timer()
+        start = timer()
+        metric = check_beam_packing(packed)
+        end = timer()
 
-    print("Elapsed time: {0:.2f} ms".format(1000 * (end - start)))
+        print("Elapsed time: {0:.2f} ms".format(1000 * (end - start)))
 
-    plot_packing_metric(metric)
+        if args.plot:
+            plots.append(executor.submit(plot_packing_metric, metric, args.publish))
 
-    plt.show()
+        # propagate any errors from the workers
+        for plot in plots:
+            plot.result()
 
 
 if __name__ == "__main__":
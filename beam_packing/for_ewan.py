@@ -23,52 +23,51 @@ def get_beam_packing(beams, nbeams=396, bunch=6):
     """
     logger = logging.getLogger()
 
-    # add additional fields for output
-    dtype = [("nr", int), ("x", float), ("y", float), ("group", int)]
-    data = np.zeros(len(beams), dtype=dtype)
-
-    data["nr"] = np.arange(len(data))
-    for field in beams.dtype.names:
-        data[field] = beams[field]
-
-    data = np.sort(data, order="x")
+    # sort in x, ties are broken by beam number
+    order = np.argsort(beams["x"], kind="stable")
 
     # only consider that many beams
-    if len(data) >= nbeams:
-        data = data[0:nbeams]
+    if len(order) >= nbeams:
+        order = order[0:nbeams]
         logger.info("Removed additional beams.")
 
-    dtype = [("nr", int), ("x", float), ("y", float), ("dist", float)]
-    group = 0
-
-    work = np.copy(data)
+    # assemble the output record with additional fields in one go
+    dtype = [("nr", int), ("x", float), ("y", float), ("group", int)]
+    data = np.zeros(len(order), dtype=dtype)
 
-    while len(work) > 0:
-        logger.debug("Length: {0}".format(len(work)))
+    data["nr"] = order
+    data["x"] = beams["x"][order]
+    data["y"] = beams["y"][order]
 
-        dist = np.sqrt(
-            (work["x"] - work["x"][0]) ** 2 + (work["y"] - work["y"][0]) ** 2
-        )
-        tot = np.zeros(len(work), dtype=dtype)
+    xs = np.ascontiguousarray(data["x"])
+    ys = np.ascontiguousarray(data["y"])
+    nrs = np.ascontiguousarray(data["nr"])
+    groups = np.zeros(len(data), dtype=int)
+    alive = np.ones(len(data), dtype=bool)
 
-        for field in ["nr", "x", "y"]:
-            tot[field] = work[field]
+    group = 0
 
-        tot["dist"] = dist
+    while np.any(alive):
+        live = np.flatnonzero(alive)
 
-        tot = np.sort(tot, order="dist")
+        # the data are sorted in x, i.e. the seed is the first remaining beam
+        seed = live[0]
+        dist = np.sqrt((xs[live] - xs[seed]) ** 2 + (ys[live] - ys[seed]) ** 2)
 
-        # pick the closest `bunch` beams
-        picked = tot[0:bunch]
-        logger.debug("Group: {0}, beams: {1}".format(group, picked["nr"]))
+        # pick the closest `bunch` beams, distance ties are broken by beam number
+        picked = live[np.lexsort((nrs[live], dist))][:bunch]
 
-        mask_work = np.isin(work["nr"], picked["nr"], invert=True)
-        mask_data = np.isin(data["nr"], picked["nr"])
-        work = work[mask_work]
-        data["group"][mask_data] = group
+        groups[picked] = group
+        alive[picked] = False
 
         group += 1
 
-    data = np.sort(data, order="group")
+    data["group"] = groups
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for group in np.unique(groups):
+            logger.debug("Group: %d, beams: %s", group, data["nr"][groups == group])
+
+    data.sort(order="group")
 
     return data
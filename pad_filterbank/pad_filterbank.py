@@ -17,6 +17,9 @@ except ImportError:
 import your
 from your.formats.filwriter import make_sigproc_object
 
+# maximum size of the blocks of data that are processed at once, in bytes
+BLOCKSIZE = 16 * 1024**2
+
 
 def parse_args():
     """
@@ -55,6 +58,14 @@ def parse_args():
         help="Enable IQRM RFI excision prior to padding."
     )
 
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        dest="plot",
+        default=False,
+        help="Plot the time series and the median bandpass of the data."
+    )
+
     args = parser.parse_args()
 
     return args
@@ -99,7 +110,159 @@ def plot_bandpass_data(bandpass, spline, padding_data):
     fig.tight_layout()
 
 
-def pad_data(filename, length, iqrm):
+def iter_blocks(yobj, blocksize=BLOCKSIZE):
+    """
+    Iterate over the filterbank data in blocks of spectra.
+
+    The blocks are of similar size and at most `blocksize` bytes large, so
+    that the full data never need to be in memory at once.
+
+    Parameters
+    ----------
+    yobj: ~your.Your
+        The input filterbank file.
+    blocksize: int or None
+        The maximum size of the blocks in bytes. Use `None` to get all data in
+        a single block.
+
+    Yields
+    ------
+    start: int
+        The index of the first spectrum in the block.
+    block: ~np.array
+        The block of spectra, which is writable.
+    """
+
+    hdr = yobj.your_header
+    nspectra = hdr.nspectra
+    nbytes = hdr.nchans * np.dtype(hdr.dtype).itemsize
+
+    if blocksize is None:
+        nblocks = 1
+    else:
+        nblocks = max(1, int(np.ceil(nspectra * nbytes / blocksize)))
+    bounds = np.linspace(0, nspectra, nblocks + 1).astype(int)
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        block = yobj.get_data(nstart=start, nsamp=end - start)
+
+        # the blocks are modified in place, but some data types are returned
+        # as read-only views of the file buffer
+        if not block.flags.writeable:
+            block = block.copy()
+
+        yield start, block
+
+
+def update_moments(count, mean, m2, block):
+    """
+    Update the running per-channel mean and sum of squared deviations.
+
+    This uses the parallel variant of Welford's algorithm to merge the
+    moments of a block of spectra, which is numerically stable.
+
+    Parameters
+    ----------
+    count: int
+        The number of spectra accumulated so far.
+    mean: ~np.array
+        The running mean of each channel.
+    m2: ~np.array
+        The running sum of squared deviations from the mean of each channel.
+    block: ~np.array
+        The block of spectra to add.
+
+    Returns
+    -------
+    count: int
+        The updated number of spectra.
+    mean: ~np.array
+        The updated mean of each channel.
+    m2: ~np.array
+        The updated sum of squared deviations of each channel.
+    """
+
+    nblock = block.shape[0]
+    block_mean = np.mean(block, axis=0, dtype=np.float64)
+    block_m2 = nblock * np.var(block, axis=0, dtype=np.float64)
+
+    total = count + nblock
+    delta = block_mean - mean
+
+    mean = mean + delta * nblock / total
+    m2 = m2 + block_m2 + delta**2 * count * nblock / total
+
+    return total, mean, m2
+
+
+def get_quantiles(counts, q):
+    """
+    Compute quantiles from histograms of integer data.
+
+    The histogram bins are the integer values starting from zero. The
+    quantiles are interpolated linearly between the order statistics like
+    `np.quantile` does, i.e. they are exact.
+
+    Parameters
+    ----------
+    counts: ~np.array
+        The histograms, the values are along the last axis.
+    q: list of float
+        The quantiles to compute.
+
+    Returns
+    -------
+    quantiles: ~np.array
+        The quantiles along the first axis.
+    """
+
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1:]
+
+    quantiles = []
+
+    for value in q:
+        pos = (total - 1) * value
+        lower = np.floor(pos)
+        upper = np.minimum(lower + 1, total - 1)
+
+        # the order statistics are the first values whose cumulative counts
+        # exceed their ranks
+        vlower = np.argmax(cumulative > lower, axis=-1)
+        vupper = np.argmax(cumulative > upper, axis=-1)
+        frac = (pos - lower)[..., 0]
+
+        quantiles.append(vlower + frac * (vupper - vlower))
+
+    return np.array(quantiles)
+
+
+def shift_data(block, shift):
+    """
+    Shift the data in amplitude in place.
+
+    Parameters
+    ----------
+    block: ~np.array
+        The data to shift.
+    shift: int
+        The amplitude shift to add.
+    """
+
+    if block.dtype == np.uint8:
+        # 8-bit data are shifted in their native width, clamp them first so
+        # that the addition saturates instead of wrapping around
+        if shift >= 0:
+            np.minimum(block, np.uint8(255 - shift), out=block)
+            block += np.uint8(shift)
+        else:
+            np.maximum(block, np.uint8(-shift), out=block)
+            block -= np.uint8(-shift)
+    else:
+        np.add(block, np.array(shift).astype(block.dtype), out=block)
+
+
+def pad_data(filename, length, iqrm, plot):
     """
     Pad the data as necessary to reach a certain length.
 
@@ -111,101 +274,171 @@ def pad_data(filename, length, iqrm):
         The length in seconds to pad the data to.
     iqrm: bool
         Whether to run IQRM RFI excision.
+    plot: bool
+        Whether to plot the time series and the median bandpass.
     """
 
     yobj = your.Your(filename)
-    print(yobj.your_header)
+    hdr = yobj.your_header
+    print(hdr)
 
-    data = yobj.get_data(nstart=0, nsamp=yobj.your_header.nspectra)
+    nspectra = hdr.nspectra
+    nchans = hdr.nchans
+    tsamp = hdr.tsamp
+    dtype = hdr.dtype
 
     # run iqrm rfi excision
     if iqrm:
-        mean = np.mean(data, axis=None)
-        spectral_std = np.std(data, axis=0)
-        mask, _ = iqrm_mask(spectral_std, radius=2)
-        print("IQRM channel mask: {}".format(np.where(mask)[0]))
+        # accumulate the spectral moments in a single pass
+        count = 0
+        chan_mean = np.zeros(nchans)
+        chan_m2 = np.zeros(nchans)
 
-        for isamp in range(data.shape[0]):
-            data[isamp, mask[0]] = mean
+        for _, block in iter_blocks(yobj):
+            count, chan_mean, chan_m2 = update_moments(count, chan_mean, chan_m2, block)
 
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
+        spectral_std = np.sqrt(chan_m2 / count)
+        fill_value = np.mean(chan_mean)
 
-    ax.plot(np.mean(data, axis=1), lw=0.5, color="black")
+        chan_mask, _ = iqrm_mask(spectral_std, radius=2)
+        print("IQRM channel mask: {}".format(np.where(chan_mask)[0]))
 
-    fig.tight_layout()
+    # compute the statistics block by block, the quartiles and the median of
+    # 8-bit data follow exactly from per-channel histograms, other data types
+    # are processed in one go
+    use_counts = np.dtype(dtype) == np.uint8
+
+    if use_counts:
+        blocksize = BLOCKSIZE
+        counts = np.zeros(nchans * 256, dtype=np.int64)
+        offsets = 256 * np.arange(nchans, dtype=np.intp)
+    else:
+        blocksize = None
+
+    if plot:
+        tseries = np.zeros(nspectra)
+
+    total = 0.0
+
+    for start, block in iter_blocks(yobj, blocksize):
+        if iqrm:
+            # replace the flagged channels in all spectra at once
+            block[:, chan_mask] = fill_value
+
+        if plot:
+            tseries[start : start + len(block)] = np.mean(block, axis=1)
 
-    mean = np.mean(data, axis=None)
-    median = np.median(data, axis=None)
-    quantiles = np.quantile(data, q=[0.25, 0.75], axis=None)
-    std = 0.7413 * np.abs(quantiles[1] - quantiles[0])
+        total += np.sum(block, dtype=np.float64)
+
+        if use_counts:
+            # histogram the values of all channels in one go
+            index = block.astype(np.intp)
+            index += offsets
+            counts += np.bincount(index.ravel(), minlength=counts.size)
+            del index
+        else:
+            chan_quantiles = np.quantile(block, q=[0.25, 0.5, 0.75], axis=0)
+
+            # the block is not needed afterwards, so partition it in place
+            quantiles = np.quantile(
+                block, q=[0.25, 0.5, 0.75], axis=None, overwrite_input=True
+            )
+
+    if use_counts:
+        counts = counts.reshape(nchans, 256)
+        chan_quantiles = get_quantiles(counts, q=[0.25, 0.5, 0.75])
+        quantiles = get_quantiles(np.sum(counts, axis=0), q=[0.25, 0.5, 0.75])
+
+    bandpass_q1, bandpass, bandpass_q3 = chan_quantiles.astype(np.float32)
+    q1, median, q3 = quantiles
+
+    if plot:
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+
+        ax.plot(tseries, lw=0.5, color="black")
+
+        fig.tight_layout()
+
+    mean = total / (nspectra * nchans)
+    std = 0.7413 * np.abs(q3 - q1)
     print(
         "Mean, median and robust std of input filterbank: {0:.4f}, {1:.4f}, {2:.4f}".format(
             mean, median, std
         )
     )
 
-    # fit median bandpass
-    bandpass = np.median(data, axis=0)
-    quantiles = np.quantile(data, q=[0.25, 0.75], axis=0)
-    bandpass_std = 0.7413 * np.abs(quantiles[1] - quantiles[0])
-    samples = np.arange(len(bandpass))
+    bandpass_std = 0.7413 * np.abs(bandpass_q3 - bandpass_q1)
 
-    mask = (bandpass >= median - 2 * std) & (bandpass <= median + 2 * std)
+    # fit median bandpass, this is for visualisation only, the padding uses
+    # the median bandpass directly
+    if plot:
+        samples = np.arange(len(bandpass))
 
-    spline = interpolate.UnivariateSpline(
-        x=samples[mask], y=bandpass[mask], k=2, s=20 * len(bandpass)
-    )
+        mask = (bandpass >= median - 2 * std) & (bandpass <= median + 2 * std)
 
-    nspectra_padding = int(
-        np.ceil(length / yobj.your_header.tsamp - yobj.your_header.nspectra)
-    )
+        spline = interpolate.UnivariateSpline(
+            x=samples[mask], y=bandpass[mask], k=2, s=20 * len(bandpass)
+        )
+
+    nspectra_padding = int(np.ceil(length / tsamp - nspectra))
     print("Number of spectra to append: {0}".format(nspectra_padding))
 
-    padding_data = np.zeros(shape=(nspectra_padding, yobj.your_header.nchans))
-    noise = np.zeros(shape=(nspectra_padding, yobj.your_header.nchans))
+    # centre the padding data in amplitude, the noise has zero mean, i.e. the
+    # mean of the padding data is that of the bandpass
+    padding_shift = np.float32(128 - np.mean(bandpass))
+    model = bandpass + padding_shift
+
+    # saturate at the range of the output data type
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+        vmin, vmax = float(limits.min), float(limits.max)
+    else:
+        vmin, vmax = -np.inf, np.inf
 
+    # draw the noise for all channels at once and scale it per channel,
+    # in single precision throughout
     rng = np.random.default_rng()
-    for ichan in range(yobj.your_header.nchans):
-        noise[:, ichan] = rng.normal(
-            loc=0, scale=bandpass_std[ichan], size=nspectra_padding
-        )
+    padding_data = rng.standard_normal(
+        size=(nspectra_padding, nchans), dtype=np.float32
+    )
+    padding_data *= bandpass_std[np.newaxis, :]
 
-    # apply the bandpass model to the padding data
-    for isamp in range(nspectra_padding):
-        for ichan in range(yobj.your_header.nchans):
-            padding_data[isamp, ichan] = bandpass[ichan] + noise[isamp, ichan]
+    # apply the shifted bandpass model to the padding data
+    padding_data += model[np.newaxis, :]
 
-    plot_bandpass_data(bandpass, spline, np.median(padding_data, axis=0))
+    # round in place and saturate
+    np.rint(padding_data, out=padding_data)
+    np.clip(padding_data, vmin, vmax, out=padding_data)
 
-    padding_data = np.round(padding_data)
-    padding_data = padding_data.astype(yobj.your_header.dtype)
+    padding_data = padding_data.astype(dtype)
 
-    print("Shape of padding data: {0}".format(padding_data.shape))
+    if plot:
+        plot_bandpass_data(
+            bandpass, spline, np.median(padding_data, axis=0) - padding_shift
+        )
 
-    # centre the data in amplitude and match the means
-    shift = int(np.round(128 - mean))
-    data = data + shift
+    print("Shape of padding data: {0}".format(padding_data.shape))
 
-    shift = int(np.round(128 - np.mean(padding_data, axis=None)))
-    padding_data = padding_data + shift
+    # centre the data in amplitude to match the padding data
+    data_shift = int(np.round(128 - mean))
 
     outname = "{0}_padded.fil".format(os.path.splitext(filename)[0])
 
     sigproc = make_sigproc_object(
         rawdatafile=outname,
-        source_name=yobj.source_name,
-        nchans=yobj.nchans,
-        foff=yobj.foff,
-        fch1=yobj.fch1,
-        tsamp=yobj.your_header.tsamp,
-        tstart=yobj.your_header.tstart,
-        src_raj=yobj.your_header.ra_deg,
-        src_dej=yobj.your_header.dec_deg,
+        source_name=hdr.source_name,
+        nchans=hdr.nchans,
+        foff=hdr.foff,
+        fch1=hdr.fch1,
+        tsamp=hdr.tsamp,
+        tstart=hdr.tstart,
+        src_raj=hdr.ra_deg,
+        src_dej=hdr.dec_deg,
         machine_id=0,
         nbeams=yobj.nbeams,
         ibeam=yobj.ibeam,
-        nbits=yobj.your_header.nbits,
+        nbits=hdr.nbits,
         nifs=1,
         barycentric=0,
         pulsarcentric=0,
@@ -217,22 +450,27 @@ def pad_data(filename, length, iqrm):
 
     sigproc.write_header(outname)
 
-    sigproc.append_spectra(data, outname)
+    # stream the shifted input data and the padding data to the output, the
+    # spectra are stored as raw binary after the header and are written
+    # without intermediate copies
+    with open(outname, "ab") as f:
+        for _, block in iter_blocks(yobj):
+            if iqrm:
+                block[:, chan_mask] = fill_value
+
+            shift_data(block, data_shift)
+            block.tofile(f)
 
-    sigproc.append_spectra(padding_data, outname)
+        padding_data.tofile(f)
 
     # check that all went fine
     padded_yobj = your.Your(outname)
     print(padded_yobj.your_header)
 
-    assert (
-        padded_yobj.your_header.nspectra == nspectra_padding + yobj.your_header.nspectra
-    )
+    assert padded_yobj.your_header.nspectra == nspectra_padding + nspectra
 
     for field in ["bw", "dtype", "nchans", "tsamp", "tstart"]:
-        assert getattr(padded_yobj.your_header, field) == getattr(
-            yobj.your_header, field
-        )
+        assert getattr(padded_yobj.your_header, field) == getattr(hdr, field)
 
 
 #
@@ -243,9 +481,10 @@ def pad_data(filename, length, iqrm):
 def main():
     args = parse_args()
 
-    pad_data(args.filename, args.length, args.iqrm)
+    pad_data(args.filename, args.length, args.iqrm, args.plot)
 
-    plt.show()
+    if args.plot:
+        plt.show()
 
     print("All done.")
 